@@ -0,0 +1,25 @@
+"""
+Loading of the per-subject BOLD time series shared by the brain state extraction scripts.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+def load_bold(csv_path):
+    """
+    Load a BOLD time series (Time x ROIs).
+
+    The .npy file written by Data_Preprocessing/convert_csv_to_npy.py is memory-mapped when it
+    exists and is not older than the CSV; otherwise the CSV is parsed, so a regenerated CSV is
+    never shadowed by an old .npy.
+
+    Returns:
+        np.ndarray: Time series (read-only if memory-mapped), or None if the CSV is missing.
+    """
+    npy_path = os.path.splitext(csv_path)[0] + '.npy'
+    csv_exists = os.path.exists(csv_path)
+    if os.path.exists(npy_path) and not (csv_exists and os.path.getmtime(csv_path) > os.path.getmtime(npy_path)):
+        return np.load(npy_path, mmap_mode='r')
+    if not csv_exists:
+        return None
+    return pd.read_csv(csv_path, header=None).values
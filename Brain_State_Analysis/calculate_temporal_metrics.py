@@ -2,10 +2,53 @@ import os
 import numpy as np
 import scipy.io
 
+def _group_label_dynamics(labels, n_states):
+    """
+    Count occupancy, blocks and transitions of all subjects' state sequences at once.
+    
+    Every count is a single np.bincount over the whole group: indices are offset by
+    subject so each subject gets its own range of bins, then reshaped per subject.
+    
+    Args:
+        labels (np.ndarray): State sequences of shape (Subjects, Time) (1-based labels).
+        n_states (int): Number of states.
+        
+    Returns:
+        tuple: (block_counts, block_sums, tp_matrix) of shapes (Subjects, States),
+               (Subjects, States) and (Subjects, States, States). block_sums is the
+               number of time points spent in each state.
+    """
+    n_subjects = labels.shape[0]
+    states = labels.astype(np.intp) - 1 # 0-based states
+    in_range = (states >= 0) & (states < n_states)
+    subj_offset = np.arange(n_subjects)[:, None]
+    state_idx = subj_offset * n_states + states
+    
+    # Time points per state
+    block_sums = np.bincount(state_idx[in_range], minlength=n_subjects * n_states)
+    
+    # Blocks per state: a block starts at the first TR and wherever the label changes
+    block_starts = np.ones_like(in_range)
+    np.not_equal(labels[:, 1:], labels[:, :-1], out=block_starts[:, 1:])
+    block_counts = np.bincount(state_idx[in_range & block_starts], minlength=n_subjects * n_states)
+    
+    # Transitions between consecutive TRs within the valid state range
+    # (self-transitions end up on the diagonal)
+    valid_pair = in_range[:, :-1] & in_range[:, 1:]
+    pair_idx = subj_offset * (n_states * n_states) + states[:, :-1] * n_states + states[:, 1:]
+    tp_matrix = np.bincount(pair_idx[valid_pair], minlength=n_subjects * n_states * n_states)
+    
+    return (block_counts.reshape(n_subjects, n_states).astype(np.float64),
+            block_sums.reshape(n_subjects, n_states).astype(np.float64),
+            tp_matrix.reshape(n_subjects, n_states, n_states).astype(np.float64))
+
 def calculate_dynamics_for_group(subject_list, data_dir, n_states, tr_duration_s, total_timepoints):
     """
     Calculate temporal dynamic metrics (FO, DT, AR, TP) for a group of subjects.
     
+    The label sequences of all subjects are stacked into one (Subjects, Time) array
+    and the metrics are computed for the whole group at once.
+    
     Args:
         subject_list (list): List of subject IDs.
         data_dir (str): Directory containing the .npy label files.
@@ -18,80 +61,45 @@ def calculate_dynamics_for_group(subject_list, data_dir, n_states, tr_duration_s
     """
     scan_length_min = (total_timepoints * tr_duration_s) / 60.0
     
-    # Initialize lists to store results
-    fo_list, dt_list, ar_list, tp_list, tp_nopersist_list = [], [], [], [], []
-
+    # Load state time series (1-based labels, stored as int8 by the extract scripts;
+    # older float64 files are converted, int8 files are used as loaded)
+    label_list = []
     for subject_id in subject_list:
         file_path = os.path.join(data_dir, f'{subject_id}_dominance_network_labels.npy')
         
         if not os.path.exists(file_path):
             print(f"Warning: File not found {file_path}, skipping subject {subject_id}.")
             continue
-            
-        # Load state time series (1-based labels)
-        time_labels = np.load(file_path).astype(int)
-        
-        # --- 1. Fractional Occupancy (FO) ---
-        fo = np.array([np.sum(time_labels == i) for i in range(1, n_states + 1)]) / total_timepoints
-        fo_list.append(fo)
-        
-        # --- 2. Dwell Time (DT) & Appearance Rate (AR) ---
-        dt_subject = np.zeros(n_states)
-        ar_subject = np.zeros(n_states)
         
-        # Find transition points
-        change_points = np.where(np.diff(time_labels) != 0)[0] + 1
-        block_starts = np.insert(change_points, 0, 0)
-        block_ends = np.append(change_points, total_timepoints)
-        
-        # Calculate block lengths and corresponding states
-        block_lengths = block_ends - block_starts
-        block_states = time_labels[block_starts] - 1 # Convert to 0-based index
-        
-        for i in range(n_states):
-            current_state_block_lengths = block_lengths[block_states == i]
-            
-            if len(current_state_block_lengths) > 0:
-                # Dwell Time = Mean block length * TR (s)
-                dt_subject[i] = np.mean(current_state_block_lengths) * tr_duration_s
-                # Appearance Rate = Number of blocks / Total scan time (min)
-                ar_subject[i] = len(current_state_block_lengths) / scan_length_min
-            else:
-                dt_subject[i] = 0
-                ar_subject[i] = 0
-        
-        dt_list.append(dt_subject)
-        ar_list.append(ar_subject)
-        
-        # --- 3. Transition Probability (TP) ---
-        tp_matrix = np.zeros((n_states, n_states))
-        states_0based = time_labels - 1 
-        
-        for t in range(total_timepoints - 1):
-            from_state = states_0based[t]
-            to_state = states_0based[t+1]
-            # Ensure valid state range
-            if 0 <= from_state < n_states and 0 <= to_state < n_states:
-                tp_matrix[from_state, to_state] += 1
-        
-        # Calculate TP with self-transitions (TP2D)
-        row_sums = tp_matrix.sum(axis=1, keepdims=True)
-        tp2d = np.divide(tp_matrix, row_sums, out=np.zeros_like(tp_matrix), where=row_sums!=0)
-        
-        # Calculate TP without self-transitions (TP2D_NoPersist)
-        tp_nopersist = tp_matrix.copy()
-        np.fill_diagonal(tp_nopersist, 0)
-        row_sums_nopersist = tp_nopersist.sum(axis=1, keepdims=True)
-        tp2d_nopersist = np.divide(tp_nopersist, row_sums_nopersist, out=np.zeros_like(tp_nopersist), where=row_sums_nopersist!=0)
-        
-        tp_list.append(tp2d)
-        tp_nopersist_list.append(tp2d_nopersist)
-        
-        # print(f"Processed subject: {subject_id}") # Uncomment for verbose output
-
-    # Stack lists into arrays and Transpose to match (n_states, n_subjects) format
-    return (np.stack(fo_list).T, np.stack(dt_list).T, np.stack(ar_list).T, 
-            np.stack(tp_list), np.stack(tp_nopersist_list))
+        label_list.append(np.load(file_path).astype(np.int8, copy=False))
+    
+    # All sequences share the scan length -> Shape: (Subjects, Time)
+    labels = np.stack(label_list)
+    
+    block_counts, block_sums, tp_matrix = _group_label_dynamics(labels, n_states)
+    
+    # --- 1. Fractional Occupancy (FO) ---
+    fo = block_sums / total_timepoints
+    
+    # --- 2. Dwell Time (DT) & Appearance Rate (AR) ---
+    # Dwell Time = Mean block length * TR (s); 0 for states that never appear
+    dt = np.divide(block_sums, block_counts, out=np.zeros_like(block_sums), where=block_counts > 0) * tr_duration_s
+    # Appearance Rate = Number of blocks / Total scan time (min)
+    ar = block_counts / scan_length_min
+    
+    # --- 3. Transition Probability (TP) ---
+    # Calculate TP with self-transitions (TP2D)
+    row_sums = tp_matrix.sum(axis=2, keepdims=True)
+    tp2d = np.divide(tp_matrix, row_sums, out=np.zeros_like(tp_matrix), where=row_sums!=0)
+    
+    # Calculate TP without self-transitions (TP2D_NoPersist)
+    tp_nopersist = tp_matrix.copy()
+    tp_nopersist[:, np.arange(n_states), np.arange(n_states)] = 0
+    row_sums_nopersist = tp_nopersist.sum(axis=2, keepdims=True)
+    tp2d_nopersist = np.divide(tp_nopersist, row_sums_nopersist, out=np.zeros_like(tp_nopersist), where=row_sums_nopersist!=0)
+    
+    # Transpose to match (n_states, n_subjects) format
+    return fo.T, dt.T, ar.T, tp2d, tp2d_nopersist
 
 
 # --- Main Execution ---
@@ -2,34 +2,18 @@ import warnings
 warnings.filterwarnings("ignore")
 import os
 import glob
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
 import pandas as pd
-import scipy.stats as stats
+from bold_io import load_bold
 
-def tr_net_labels(df, nlabels, activity_thr):
-    """
-    Determine the dominant network for a single time point.
-    
-    Averages amplitude network-wise for each time point and assigns the label 
-    of the network with the highest amplitude. If no network surpasses the 
-    activity_thr, assigns the extra label NOTA ('None Of The Above').
-    
-    Returns:
-        int: Index of the dominant network (1-based). Returns nlabels (NOTA) if threshold not met.
-    """
-    net_means = []
-    # Loop through networks (1 to nlabels-1, excluding NOTA)
-    for i in range(1, nlabels):
-        mean_val = df[df['network_id'] == i]['value'].mean()
-        net_means.append(mean_val)
-    
-    net_means = np.array(net_means)
-    idx = np.argmax(net_means)
-    
-    if net_means[idx] >= activity_thr:
-        return idx + 1
-    else:
-        return nlabels
+# Parquet output needs pyarrow (optional); without it the state maps are written as CSV
+try:
+    import pyarrow # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
 
 # ------- Configuration -------
 # Define dataset groups
@@ -43,6 +27,7 @@ ATLAS_ORDER_FILE = '../resources/BNA_210_yeo_order.csv'
 
 # Parameters
 ACTIVITY_THR = 0 # Threshold for activity
+N_WORKERS = os.cpu_count() # Number of subjects processed in parallel
 
 # Define network labels
 # NOTA is included for noise handling (thresholding)
@@ -61,93 +46,130 @@ nrois = len(atlas_order)
 id2net = dict(zip(np.arange(nlabels) + 1, LABELS))
 roi2id = dict(zip(atlas_order['ROI'], atlas_order['network_id']))
 
-# ------- Main Processing Loop -------
+# ROI -> network grouping used to label every TR.
+# Columns are sorted by network so each network becomes one contiguous slice.
+roi_net_ids = np.array([roi2id[roi] for roi in range(1, nrois + 1)])
+roi_perm = np.argsort(roi_net_ids, kind='stable')
+reduceat_idx = np.searchsorted(roi_net_ids[roi_perm], np.arange(1, nlabels))
+net_roi_counts = np.bincount(roi_net_ids, minlength=nlabels)[1:nlabels]
+if np.any(net_roi_counts == 0):
+    raise ValueError("Every network (excluding NOTA) must contain at least one ROI.")
 
-for dataset in datasets:
-    print(f"Processing dataset: {dataset}")
+# ------- Subject Processing -------
+
+def _process_subject(subj_id, dataset_dir, output_dir):
+    """
+    Extract the brain state sequence and state maps for a single subject.
     
-    dataset_dir = os.path.join(ROOT_DIR, f'rfMRI_bold_{dataset}')
-    output_dir = os.path.join(OUTPUT_ROOT, dataset, f'thr_{ACTIVITY_THR}')
+    Saves the dominance labels and the states matrix to output_dir.
     
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        
-    # Load subject list
-    subject_list_path = os.path.join(ROOT_DIR, f'{dataset}_list.txt')
-    subjects = np.loadtxt(subject_list_path).astype(int)
+    Returns:
+        tuple: (time_labels, state_maps) with state_maps of shape (nlabels, ROIs),
+               or None if the time series file is missing.
+    """
+    print(f'  Starting subject {subj_id}')
+    
+    # Load time series (.npy from convert_csv_to_npy.py if up to date, else CSV)
+    ttss_path = os.path.join(dataset_dir, f'{subj_id}_bold.csv')
+    ttss_246 = load_bold(ttss_path) # Shape: (Time, ROIs)
+    if ttss_246 is None:
+        print(f"    Warning: File not found {ttss_path}, skipping.")
+        return None
+    
+    # Use first 210 ROIs (excluding subcortical regions if consistent with BNA_210_yeo_order)
+    # (copied to float32 so the normalization below can work in place)
+    ttss = np.array(ttss_246[:, :210], dtype=np.float32)
     
-    # DataFrame to store group-level state maps
-    group_states = pd.DataFrame(columns=['subject', 'state', 'value'])
+    # Z-score normalization along time axis (constant ROIs are left at 0)
+    ttss -= ttss.mean(axis=0)
+    sd = ttss.std(axis=0)
+    sd[sd == 0] = 1.0
+    ttss /= sd
+
+    n_timepoints = ttss.shape[0]
+    n_rois_curr = ttss.shape[1]
+
+    # Calculate dominant network for each TR
+    # Averages amplitude network-wise for all TRs at once -> (Time, Networks).
+    # If no network surpasses ACTIVITY_THR, the TR is labelled NOTA.
+    net_means = np.add.reduceat(ttss[:, roi_perm], reduceat_idx, axis=1) / net_roi_counts
+    idx = net_means.argmax(axis=1)
+    max_val = net_means[np.arange(n_timepoints), idx]
+    time_labels = np.where(max_val >= ACTIVITY_THR, idx + 1, nlabels).astype(np.int8)
+
+    # Save dominance labels (The state sequence)
+    np.save(os.path.join(output_dir, f'{subj_id}_dominance_network_labels.npy'), time_labels)
+    
+    # --- Create State Maps (Mean activity during dominance) ---
+    # One broadcast comparison -> (Time, nlabels) boolean masks
+    state_masks = time_labels[:, None] == np.arange(1, len(LABELS) + 1)
+
+    state_maps = np.zeros((nlabels, n_rois_curr), dtype=np.float32) # Zeros where a state never appears
+    for i, mask in enumerate(state_masks.T):
+        # Calculate mean activity pattern for this state
+        if np.sum(mask) > 0:
+            state_maps[i] = np.mean(ttss[mask], axis=0)
+
+    # States matrix (ROIs x States, NOTA excluded) loaded directly by the control energy scripts
+    np.save(os.path.join(output_dir, f'{subj_id}_states_matrix.npy'), state_maps[:-1].T)
+
+    return time_labels, state_maps
 
-    for subj_id in subjects:
-        print(f'  Starting subject {subj_id}')
+# ------- Main Processing Loop -------
+
+if __name__ == "__main__":
+    for dataset in datasets:
+        print(f"Processing dataset: {dataset}")
         
-        # Load time series
-        ttss_path = os.path.join(dataset_dir, f'{subj_id}_bold.csv')
-        if not os.path.exists(ttss_path):
-            print(f"    Warning: File not found {ttss_path}, skipping.")
-            continue
-            
-        ttss_246 = pd.read_csv(ttss_path, header=None).values # Shape: (Time, ROIs)
+        dataset_dir = os.path.join(ROOT_DIR, f'rfMRI_bold_{dataset}')
+        output_dir = os.path.join(OUTPUT_ROOT, dataset, f'thr_{ACTIVITY_THR}')
         
-        # Use first 210 ROIs (excluding subcortical regions if consistent with BNA_210_yeo_order)
-        ttss = ttss_246[:, :210] 
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+            
+        # Load subject list
+        subject_list_path = os.path.join(ROOT_DIR, f'{dataset}_list.txt')
+        subjects = np.loadtxt(subject_list_path).astype(int)
         
-        # Z-score normalization along time axis
-        ttss = stats.zscore(ttss, axis=0)
-
-        # Prepare dataframe for processing
-        # Flatten array: [Time, ROI] -> [ROI, Time] (transposed) -> Flattened
-        ttss_vec = ttss.T.flatten() 
-        n_timepoints = ttss.shape[0]
-        n_rois_curr = ttss.shape[1]
+        # Subjects are independent: process them in parallel worker processes
+        worker = partial(_process_subject, dataset_dir=dataset_dir, output_dir=output_dir)
+        with ProcessPoolExecutor(max_workers=N_WORKERS) as executor:
+            results = list(executor.map(worker, subjects, chunksize=4))
         
-        roi_order = np.repeat(np.arange(n_rois_curr), n_timepoints) + 1 
-        time_order = np.tile(np.arange(n_timepoints), n_rois_curr)
+        # Subjects with a time series, in subject order
+        processed = [(subj_id, result[1]) for subj_id, result in zip(subjects, results) if result is not None]
+        if not processed:
+            print(f"No state data generated for {dataset}.")
+            continue
 
-        ttss_df = pd.DataFrame({
-            'value': pd.Series(ttss_vec, dtype='float'),
-            'roi': pd.Series(roi_order, dtype='int32'),
-            'tr': pd.Series(time_order, dtype='int32'),
+        subj_ids, state_maps = zip(*processed)
+        state_maps = np.stack(state_maps) # Shape: (Subjects, States, ROIs)
+        n_subjects, n_states, n_rois_curr = state_maps.shape
+
+        # Group-level state maps in long format, built once from the stacked arrays
+        # Row order: subject -> state -> ROI
+        group_states = pd.DataFrame({
+            'subject': np.repeat(np.array(subj_ids).astype(str), n_states * n_rois_curr),
+            'state': np.tile(np.repeat(LABELS, n_rois_curr), n_subjects),
+            'value': state_maps.ravel(),
+            'ROI': np.tile(atlas_order['ROI'].to_numpy(), n_subjects * n_states),
+            'network_id': np.tile(atlas_order['network_id'].to_numpy(), n_subjects * n_states),
         })
-        
-        # Map ROIs to Networks
-        ttss_df['network_id'] = ttss_df['roi'].map(roi2id)
-        # ttss_df['network'] = ttss_df['network_id'].map(id2net) # Optional for debug
-
-        # Calculate dominant network for each TR
-        time_labels = np.zeros(n_timepoints)
-        for tr in range(n_timepoints):
-            temp_label = tr_net_labels(ttss_df[ttss_df.tr == tr], nlabels, ACTIVITY_THR)
-            time_labels[tr] = temp_label
-
-        # Save dominance labels (The state sequence)
-        np.save(os.path.join(output_dir, f'{subj_id}_dominance_network_labels.npy'), time_labels)
-        
-        # --- Create State Maps (Mean activity during dominance) ---
-        state_masks = pd.DataFrame({
-            lab: (time_labels == lab_idx + 1) for lab_idx, lab in enumerate(LABELS)
-        }).values
-
-        for i, mask in enumerate(state_masks.T):
-            # Calculate mean activity pattern for this state
-            if np.sum(mask) > 0:
-                state_map = np.mean(ttss[mask], axis=0)
-            else:
-                state_map = np.zeros(n_rois_curr) # Handle case where state never appears
-
-            tmp_df = atlas_order[['ROI', 'network_id']].copy()
-            tmp_df['subject'] = f'{subj_id}'
-            tmp_df['state'] = LABELS[i]
-            tmp_df['value'] = state_map
-            
-            # Note: In newer pandas versions, append is deprecated. Using concat is preferred.
-            group_states = pd.concat([group_states, tmp_df], ignore_index=True)
-
-    # Clean up types
-    group_states['ROI'] = group_states['ROI'].fillna(0).astype(int)
-    group_states['network_id'] = group_states['network_id'].fillna(0).astype(int)
 
-    # Save group-level state maps
-    group_states.to_csv(os.path.join(output_dir, 'state-maps_subject-level.csv'), index=False)
-    print(f"Finished processing {dataset}. Results saved.")
+        # Clean up types
+        group_states['ROI'] = group_states['ROI'].fillna(0).astype(int)
+        group_states['network_id'] = group_states['network_id'].fillna(0).astype(int)
+
+        # Save group-level state maps (compressed Parquet if pyarrow is available, else CSV).
+        # A table left over in the other format by an earlier run is removed so readers never pick it up.
+        parquet_path = os.path.join(output_dir, 'state-maps_subject-level.parquet')
+        csv_path = os.path.join(output_dir, 'state-maps_subject-level.csv')
+        if HAS_PYARROW:
+            group_states.to_parquet(parquet_path, index=False, compression='zstd')
+            stale_path = csv_path
+        else:
+            group_states.to_csv(csv_path, index=False)
+            stale_path = parquet_path
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+        print(f"Finished processing {dataset}. Results saved.")
@@ -1,39 +1,25 @@
 import warnings
 warnings.filterwarnings("ignore")
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
 import pandas as pd
-import scipy.stats as stats
+from bold_io import load_bold
 
-def tr_net_labels(df, nlabels, activity_thr):
-    """
-    Determine the dominant network for a single time point.
-    
-    Averages amplitude network-wise for each time point.
-    If the highest amplitude >= activity_thr, returns the network ID (1-based).
-    Otherwise, returns nlabels (which corresponds to NOTA).
-    """
-    net_means = []
-    # Loop through networks (1 to nlabels-1). 
-    # nlabels acts as the index for NOTA.
-    for i in range(1, nlabels):
-        val = df[df['network_id'] == i]['value'].mean()
-        net_means.append(val)
-    
-    net_means = np.array(net_means)
-    idx = np.argmax(net_means)
-    
-    # Check threshold logic (Standard for NoLIM analysis)
-    if net_means[idx] >= activity_thr:
-        return idx + 1
-    else:
-        return nlabels
+# Parquet output needs pyarrow (optional); without it the state maps are written as CSV
+try:
+    import pyarrow # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
 
 # ==========================================
 # Configuration
 # ==========================================
 datasets = ['HC', 'MDD']
 activity_thr = 0
+n_workers = os.cpu_count() # Number of subjects processed in parallel
 
 # Paths (Relative paths for portability)
 ROOT_DIR = '../../ukb_raw_data/'
@@ -83,100 +69,129 @@ print(f"Remaining ROIs: {nrois}")
 
 # Create Mappings
 id2net = dict(zip(np.arange(nlabels) + 1, labels)) 
-roi2id = dict(zip(atlas_order['ROI'], atlas_order['network_id'])) 
+
+# ROI -> (New) Network grouping used to label every TR.
+# Data columns follow the atlas_order rows; sorting them by network makes
+# each network one contiguous slice.
+roi_net_ids = atlas_order['network_id'].to_numpy()
+roi_perm = np.argsort(roi_net_ids, kind='stable')
+reduceat_idx = np.searchsorted(roi_net_ids[roi_perm], np.arange(1, nlabels))
+net_roi_counts = np.bincount(roi_net_ids, minlength=nlabels)[1:nlabels]
 
 
 # 2. Process Subjects
-for dataset in datasets:
-    print(f"\nProcessing Group: {dataset}")
+def _process_subject(subj_id, dataset_dir, output_dir):
+    """
+    Extract the NoLIM brain state sequence and state maps for a single subject.
     
-    dataset_dir = os.path.join(ROOT_DIR, f'rfMRI_bold_{dataset}')
-    output_dir = os.path.join(OUTPUT_ROOT, dataset, f'thr_{activity_thr}')
+    Saves the dominance labels and the states matrix to output_dir and returns
+    (time_labels, state_maps), with state_maps of shape (nlabels, ROIs),
+    or None if the time series is missing.
+    """
+    # Load Time Series (.npy from convert_csv_to_npy.py if up to date, else CSV)
+    ttss_path = os.path.join(dataset_dir, f'{subj_id}_bold.csv')
+    ttss_246 = load_bold(ttss_path)
+    if ttss_246 is None:
+        return None
     
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        
-    subject_list_path = os.path.join(ROOT_DIR, f'{dataset}_list.txt')
-    if not os.path.exists(subject_list_path):
-        print(f"Subject list not found: {subject_list_path}")
-        continue
-    subjects = np.loadtxt(subject_list_path).astype(int)
+    # Cut to 210 and then filter for NoLIM ROIs
+    ttss_full = ttss_246[:, :210]
+    ttss = ttss_full[:, rois_to_keep_indices].astype(np.float32, copy=False)
+
+    # Z-score normalization (in place; constant ROIs are left at 0)
+    ttss -= ttss.mean(axis=0)
+    sd = ttss.std(axis=0)
+    sd[sd == 0] = 1.0
+    ttss /= sd
+    
+    n_timepoints = ttss.shape[0]
+    curr_n_rois = ttss.shape[1]
+
+    # Calculate Labels
+    # Network-wise mean amplitude for all TRs at once -> (Time, Networks).
+    # Highest amplitude >= activity_thr gives the network ID (1-based), otherwise NOTA.
+    net_means = np.add.reduceat(ttss[:, roi_perm], reduceat_idx, axis=1) / net_roi_counts
+    idx = net_means.argmax(axis=1)
+    max_val = net_means[np.arange(n_timepoints), idx]
+    time_labels = np.where(max_val >= activity_thr, idx + 1, nlabels).astype(np.int8)
+
+    np.save(os.path.join(output_dir, f'{subj_id}_dominance_network_labels.npy'), time_labels)
+    
+    # Generate State Maps (using new labels list)
+    # One broadcast comparison -> (Time, nlabels) boolean masks
+    state_masks = time_labels[:, None] == np.arange(1, len(labels) + 1)
+
+    state_maps = np.zeros((nlabels, curr_n_rois), dtype=np.float32)
+    for i, mask in enumerate(state_masks.T):
+        if np.sum(mask) > 0:
+            state_maps[i] = np.mean(ttss[mask], axis=0)
+    
+    # States matrix (ROIs x States) loaded directly by the control energy scripts;
+    # NOTA and states without values are excluded, as in the group table
+    network_maps = state_maps[:-1]
+    network_maps = network_maps[~np.all(np.isnan(network_maps), axis=1)]
+    np.save(os.path.join(output_dir, f'{subj_id}_states_matrix.npy'), network_maps.T)
     
-    all_states_list = []
+    # print(f"  Processed {subj_id}")
+    return time_labels, state_maps
 
-    for subj_id in subjects:
-        # Load Time Series
-        ttss_path = os.path.join(dataset_dir, f'{subj_id}_bold.csv')
-        if not os.path.exists(ttss_path):
-            continue
-            
-        ttss_246 = pd.read_csv(ttss_path, header=None).values
-        
-        # Cut to 210 and then filter for NoLIM ROIs
-        ttss_full = ttss_246[:, :210]
-        ttss = ttss_full[:, rois_to_keep_indices]
 
-        # Z-score normalization
-        ttss = stats.zscore(ttss, axis=0)
-        
-        # Flatten
-        ttss_vec = ttss.T.flatten()
-        n_timepoints = ttss.shape[0]
-        curr_n_rois = ttss.shape[1]
+if __name__ == "__main__":
+    for dataset in datasets:
+        print(f"\nProcessing Group: {dataset}")
         
-        roi_order = np.repeat(np.arange(curr_n_rois), n_timepoints) + 1
-        time_order = np.tile(np.arange(n_timepoints), curr_n_rois)
-
-        ttss_df = pd.DataFrame({
-            'value': pd.Series(ttss_vec, dtype='float'),
-            'roi': pd.Series(roi_order, dtype='int32'),
-            'tr': pd.Series(time_order, dtype='int32'),
-        })
+        dataset_dir = os.path.join(ROOT_DIR, f'rfMRI_bold_{dataset}')
+        output_dir = os.path.join(OUTPUT_ROOT, dataset, f'thr_{activity_thr}')
         
-        # Correctly map continuous ROI index (1..N) back to Original ROI ID
-        continuous_roi_to_original_roi = dict(enumerate(atlas_order['ROI'], 1))
-        ttss_df['original_roi'] = ttss_df['roi'].map(continuous_roi_to_original_roi)
-        
-        # Map to (New) Network ID
-        ttss_df['network_id'] = ttss_df['original_roi'].map(roi2id)
-        # ttss_df['network'] = ttss_df['network_id'].map(id2net)
-
-        # Calculate Labels
-        time_labels = np.zeros(n_timepoints)
-        for tr in range(n_timepoints):
-            temp_label = tr_net_labels(ttss_df[ttss_df.tr==tr], nlabels, activity_thr)
-            time_labels[tr] = temp_label
-
-        np.save(os.path.join(output_dir, f'{subj_id}_dominance_network_labels.npy'), time_labels)
-        
-        # Generate State Maps (using new labels list)
-        state_masks = pd.DataFrame({
-            lab: (time_labels == lab_idx + 1) for lab_idx, lab in enumerate(labels)
-        }).values
-
-        for i, mask in enumerate(state_masks.T):
-            if np.sum(mask) > 0:
-                state_mean = np.mean(ttss[mask], axis=0)
-            else:
-                state_mean = np.zeros(curr_n_rois)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
             
-            if not np.all(np.isnan(state_mean)):
-                tmp_df = atlas_order[['ROI', 'network_id']].copy()
-                tmp_df['subject'] = f'{subj_id}'
-                tmp_df['state'] = labels[i]
-                tmp_df['value'] = state_mean
-                all_states_list.append(tmp_df)
+        subject_list_path = os.path.join(ROOT_DIR, f'{dataset}_list.txt')
+        if not os.path.exists(subject_list_path):
+            print(f"Subject list not found: {subject_list_path}")
+            continue
+        subjects = np.loadtxt(subject_list_path).astype(int)
         
-        # print(f"  Processed {subj_id}")
-
-    # Save Group Results
-    if all_states_list:
-        group_states = pd.concat(all_states_list, ignore_index=True)
-        group_states['ROI'] = group_states['ROI'].astype(int)
-        group_states['network_id'] = group_states['network_id'].astype(int)
+        # Subjects are independent: process them in parallel worker processes
+        worker = partial(_process_subject, dataset_dir=dataset_dir, output_dir=output_dir)
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(worker, subjects, chunksize=4))
         
-        save_path = os.path.join(output_dir, 'state-maps_subject-level.csv')
-        group_states.to_csv(save_path, index=False)
-        print(f"Saved NoLIM state maps to: {save_path}")
-    else:
-        print("No state data generated.")
+        # Subjects with a time series, in subject order
+        processed = [(subj_id, result[1]) for subj_id, result in zip(subjects, results) if result is not None]
+
+        # Save Group Results
+        if processed:
+            subj_ids, state_maps = zip(*processed)
+            state_maps = np.stack(state_maps) # Shape: (Subjects, States, ROIs)
+            n_subjects, n_states, curr_n_rois = state_maps.shape
+
+            # Long format (subject -> state -> ROI), built once from the stacked arrays.
+            # States whose map is entirely NaN are dropped.
+            group_states = pd.DataFrame({
+                'ROI': np.tile(atlas_order['ROI'].to_numpy(), n_subjects * n_states),
+                'network_id': np.tile(atlas_order['network_id'].to_numpy(), n_subjects * n_states),
+                'subject': np.repeat(np.array(subj_ids).astype(str), n_states * curr_n_rois),
+                'state': np.tile(np.repeat(labels, curr_n_rois), n_subjects),
+                'value': state_maps.ravel(),
+            })
+            valid_states = ~np.all(np.isnan(state_maps), axis=2)
+            group_states = group_states[np.repeat(valid_states.ravel(), curr_n_rois)].reset_index(drop=True)
+            group_states['ROI'] = group_states['ROI'].astype(int)
+            group_states['network_id'] = group_states['network_id'].astype(int)
+            
+            # Compressed Parquet if pyarrow is available, else CSV.
+            # A table left over in the other format by an earlier run is removed so readers never pick it up.
+            parquet_path = os.path.join(output_dir, 'state-maps_subject-level.parquet')
+            csv_path = os.path.join(output_dir, 'state-maps_subject-level.csv')
+            if HAS_PYARROW:
+                save_path, stale_path = parquet_path, csv_path
+                group_states.to_parquet(save_path, index=False, compression='zstd')
+            else:
+                save_path, stale_path = csv_path, parquet_path
+                group_states.to_csv(save_path, index=False)
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+            print(f"Saved NoLIM state maps to: {save_path}")
+        else:
+            print("No state data generated.")
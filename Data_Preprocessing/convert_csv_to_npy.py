@@ -0,0 +1,47 @@
+# One-time conversion of the per-subject CSV matrices to binary .npy files.
+# Downstream scripts load the .npy file when it is not older than the CSV and fall back to the CSV otherwise.
+import argparse
+import glob
+import os
+import numpy as np
+import pandas as pd
+
+def convert_files(pattern, dtype, overwrite=False):
+    """
+    Save every CSV matching pattern next to itself as a .npy file of the given dtype.
+
+    Args:
+        pattern (str): Glob pattern of the CSV files (no header, numeric only).
+        dtype (type): dtype of the saved arrays.
+        overwrite (bool): Re-create .npy files that already exist (a .npy file older than its
+            CSV is always re-created).
+
+    Returns:
+        int: Number of files converted.
+    """
+    n_converted = 0
+    for csv_path in sorted(glob.glob(pattern)):
+        npy_path = os.path.splitext(csv_path)[0] + '.npy'
+        # Keep .npy files that are not older than their CSV
+        if os.path.exists(npy_path) and not overwrite and os.path.getmtime(npy_path) >= os.path.getmtime(csv_path):
+            continue
+        np.save(npy_path, pd.read_csv(csv_path, header=None).to_numpy(dtype=dtype))
+        n_converted += 1
+    return n_converted
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert BOLD time series and SC matrices from CSV to .npy.")
+    parser.add_argument("--root_dir", default='../../ukb_raw_data/', help="Path to raw data")
+    parser.add_argument("--groups", nargs='+', default=['HC', 'MDD'], help="Group conditions")
+    parser.add_argument("--overwrite", action='store_true', help="Re-create existing .npy files")
+
+    args = parser.parse_args()
+
+    for group in args.groups:
+        # BOLD time series (Time x ROIs), stored as float32
+        n_bold = convert_files(os.path.join(args.root_dir, f'rfMRI_bold_{group}', '*_bold.csv'),
+                               np.float32, args.overwrite)
+        # Structural connectivity (ROIs x ROIs), kept in float64 for the control energy solver
+        n_sc = convert_files(os.path.join(args.root_dir, f'sc_{group}', '*_FA_sc.csv'),
+                             np.float64, args.overwrite)
+        print(f"{group}: converted {n_bold} BOLD and {n_sc} SC files.")
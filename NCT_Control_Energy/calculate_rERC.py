@@ -88,16 +88,21 @@ def main(root_dir, add1_dir, baseline_csv_dir, list_dir, output_dir):
             print(f"\nProcessing: Threshold={thre_type}, T={T_value}")
             
             # 1. Load Baseline Energy (aveTE_0) DataFrame
-            # Assumes this file was generated by organize_energy_results.py
-            # Filename: df_aveTE_T{T}_{thr}.csv (Using your standard naming)
+            # Assumes this file was generated by organize_energy_results.py:
+            # the ave_TE rows of df_energy_metrics_T{T}_{thr}.parquet,
+            # else the legacy CSV df_aveTE_T{T}_{thr}.csv (Using your standard naming)
             # Note: Your code referenced 'df_aveTE_42_...'. Adjust if needed.
+            metrics_file = os.path.join(baseline_csv_dir, f'df_energy_metrics_T{T_value}_{thre_type}.parquet')
             baseline_file = os.path.join(baseline_csv_dir, f'df_aveTE_T{T_value}_{thre_type}.csv')
             
-            if not os.path.exists(baseline_file):
+            if os.path.exists(metrics_file):
+                source_E_df = pd.read_parquet(metrics_file, filters=[('metric', '==', 'ave_TE')]) \
+                    .rename(columns={'value': 'ave_TE'})
+            elif os.path.exists(baseline_file):
+                source_E_df = pd.read_csv(baseline_file)
+            else:
                 print(f"  Skipping: Baseline file not found ({baseline_file})")
                 continue
-                
-            source_E_df = pd.read_csv(baseline_file)
             
             delta_ratios_all = []
             
@@ -141,7 +146,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Calculate Regional Energy Regulation Capacity (rERC).")
     parser.add_argument("--root_dir", default='../../ukb_raw_data/', help="Root data directory")
     parser.add_argument("--add1_dir", default='../results/energy/B_add1', help="Directory containing B_add1 .mat files")
-    parser.add_argument("--baseline_dir", default='../results/df_FoDtAr_TP_E/', help="Directory containing baseline aveTE CSVs")
+    parser.add_argument("--baseline_dir", default='../results/df_FoDtAr_TP_E/', help="Directory containing baseline energy metrics (organize_energy_results.py output)")
     parser.add_argument("--output_dir", default='../results/df_FoDtAr_TP_E/', help="Directory to save rERC CSVs")
     
     args = parser.parse_args()
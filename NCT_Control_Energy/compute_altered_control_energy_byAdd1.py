@@ -2,43 +2,17 @@ import argparse
 import os
 import sys
 import numpy as np
-import pandas as pd
 import scipy.io as sio
 
 # Import nctpy functions
 try:
-    from nctpy.pipelines import ComputeControlEnergy
-    from nctpy.utils import normalize_state
+    from nctpy.utils import matrix_normalization
 except ImportError:
     print("Error: nctpy toolbox not found. Please ensure it is installed.")
     sys.exit(1)
 
-def assemble_control_tasks(states_x0, states_xf, control_set, n_nodes):
-    """
-    Assemble control tasks with a specific control input matrix B.
-    """
-    n_states = states_x0.shape[1]
-    control_tasks = []
-
-    # Constraints and Parameters
-    trajectory_constraints = np.eye(n_nodes)
-    rho = 1
-
-    for initial_idx in range(n_states):
-        initial_state = normalize_state(states_x0[:, initial_idx])
-        for target_idx in range(n_states):
-            target_state = normalize_state(states_xf[:, target_idx])
-
-            control_task = {
-                "x0": initial_state,
-                "xf": target_state,
-                "B": control_set,  # This is the customized B matrix
-                "S": trajectory_constraints,
-                "rho": rho
-            }
-            control_tasks.append(control_task)        
-            
-    return control_tasks   
+from nct_io import load_sc, load_states_matrix
+from nct_solver import normalize_states, transition_energy_matrix
 
 def get_regional_control_energy(subject_id, condition_type, threshold, root_dir, output_root, states_root, n_roi=210):
     """
@@ -61,45 +35,22 @@ def get_regional_control_energy(subject_id, condition_type, threshold, root_dir,
         os.makedirs(results_dir, exist_ok=True)
     
     # 2. Load Brain States
-    states_file = os.path.join(states_root, condition_type, threshold, 'state-maps_subject-level.csv')
-    if not os.path.exists(states_file):
-        print(f"Error: State file not found at {states_file}")
-        return
-
-    states_all_df = pd.read_csv(states_file) 
-    
-    # Filter for current subject
-    states_all_df['subject'] = states_all_df['subject'].astype(str)
-    subj_states_df = states_all_df[states_all_df['subject'] == str(subject_id)]
-    
-    if subj_states_df.empty:
-        print(f"Warning: No states found for subject {subject_id}")
+    # Per-subject states matrix (Nodes x States) saved by the extract scripts if available,
+    # otherwise the subject is selected from the group state maps table
+    states_matrix = load_states_matrix(os.path.join(states_root, condition_type, threshold), subject_id, n_roi)
+    if states_matrix is None:
         return
-
-    # Define Labels (Dynamically detected)
-    # Assumes standard labels, but works if subset is present
-    standard_labels = ['Vis', 'SomMot', 'DorsAttn', 'VentAttn', 'Limbic', 'Frontoparietal', 'Default']
-    present_labels = [l for l in standard_labels if l in subj_states_df['state'].unique()]
-    
-    n_states = len(present_labels)
-    states_matrix = np.zeros((n_roi, n_states))
-
-    for idx, label in enumerate(present_labels):
-        temp_state = subj_states_df[subj_states_df['state'] == label]['value'].values
-        if len(temp_state) == n_roi:
-            states_matrix[:, idx] = temp_state
-        else:
-             print(f"Error: Dimension mismatch. Expected {n_roi}, got {len(temp_state)}")
-             return
+    n_states = states_matrix.shape[1]
 
     # 3. Load Structural Connectivity (A Matrix)
+    # (.npy cache if available, else CSV)
     adjacency_path = os.path.join(root_dir, f'sc_{condition_type}', f'{subject_id}_FA_sc.csv')
-    if not os.path.exists(adjacency_path):
+    adjacency_temp = load_sc(adjacency_path)
+    if adjacency_temp is None:
         print(f"Error: SC file not found at {adjacency_path}")
         return
         
-    adjacency_temp = pd.read_csv(adjacency_path, header=None).values
-    adjacency_temp = adjacency_temp[:n_roi, :n_roi]   
+    adjacency_temp = np.array(adjacency_temp[:n_roi, :n_roi])
     np.fill_diagonal(adjacency_temp, 0)
 
     # 4. Regional Perturbation Loop
@@ -109,32 +60,37 @@ def get_regional_control_energy(subject_id, condition_type, threshold, root_dir,
 
     print(f'Starting Regional Analysis for Subject: {subject_id} ({condition_type})', flush=True)
 
+    # The states do not depend on k: normalize them once (every state is both an initial and a
+    # target state) and use them with a single B matrix. B is Identity; each iteration raises
+    # the k-th diagonal element to 2 in place and restores it afterwards.
+    control_set = np.eye(n_roi)
+    states_norm = normalize_states(states_matrix)
+
+    # Constraints and Parameters
+    trajectory_constraints = np.eye(n_roi)
+    rho = 1
+
+    # A does not depend on k: normalize it once (continuous system, c=1, as in ComputeControlEnergy).
+    # All n_states x n_states transitions of one B then come from one solve of the system.
+    A_norm = matrix_normalization(adjacency_temp, system="continuous", c=1)
+
     for k in range(n_roi):
         # Construct heterogeneous control set
-        # B matrix is Identity, but the k-th diagonal element is increased to 2
-        control_set = np.eye(n_roi) 
         control_set[k, k] = 2 
 
         if k % 20 == 0: # Log progress every 20 nodes
             print(f'  Processing ROI {k}/{n_roi}...', flush=True)                             
-        
-        control_tasks_temp = assemble_control_tasks(states_matrix, states_matrix, control_set, n_roi) 
             
         # Compute Control Energy (T=1)
-        compute_energy_t1 = ComputeControlEnergy(
-            A=adjacency_temp, control_tasks=control_tasks_temp, system="continuous", c=1, T=1
-        )
-        compute_energy_t1.run()        
-        optimal_control_energy_t1[k, :, :] = np.reshape(compute_energy_t1.E, (n_states, n_states))
-        del compute_energy_t1
+        optimal_control_energy_t1[k, :, :] = transition_energy_matrix(A_norm, control_set, states_norm, states_norm,
+                                                                      T=1, rho=rho, S=trajectory_constraints)
 
         # Compute Control Energy (T=3) - Optional
-        # compute_energy_t3 = ComputeControlEnergy(
-        #     A=adjacency_temp, control_tasks=control_tasks_temp, system="continuous", c=1, T=3
-        # )
-        # compute_energy_t3.run()        
-        # optimal_control_energy_t3[k, :, :] = np.reshape(compute_energy_t3.E, (n_states, n_states))
-        # del compute_energy_t3
+        # optimal_control_energy_t3[k, :, :] = transition_energy_matrix(A_norm, control_set, states_norm, states_norm,
+        #                                                               T=3, rho=rho, S=trajectory_constraints)
+
+        # Restore uniform control weight for the next ROI
+        control_set[k, k] = 1
               
     # 5. Save Results
     print(f'Saving regional energy results for {subject_id}...')
@@ -1,60 +1,28 @@
 import argparse
 import os
 import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 import numpy as np
-import pandas as pd
 import scipy.io as sio
 
 # Import nctpy functions (Ensure nctpy is installed or in PYTHONPATH)
 try:
-    from nctpy.pipelines import ComputeControlEnergy
-    from nctpy.utils import normalize_state
+    from nctpy.utils import matrix_normalization
 except ImportError:
     print("Error: nctpy toolbox not found. Please install it from https://github.com/LindenParkesLab/nctpy")
     sys.exit(1)
 
-def assemble_control_tasks(states_x0, states_xf, control_set, n_nodes):
-    """
-    Assemble a list of control tasks for calculating transition energy between all pairs of states.
-    
-    Args:
-        states_x0 (np.ndarray): Initial states matrix (Nodes x States).
-        states_xf (np.ndarray): Target states matrix (Nodes x States).
-        control_set (np.ndarray): Control input matrix B (Nodes x Nodes).
-        n_nodes (int): Number of brain nodes.
-        
-    Returns:
-        list: A list of dictionary objects, each defining a control task (x0 -> xf).
-    """
-    n_states = states_x0.shape[1]
-    control_tasks = []
-
-    # Define state trajectory constraints (constrain full state trajectory equally)
-    trajectory_constraints = np.eye(n_nodes)
+from nct_io import load_sc, load_states_matrix, load_states_table, states_matrix_from_table, states_npy_path
+from nct_solver import normalize_states, transition_energy_matrix
 
-    # Define mixing parameter rho (weighting for energy cost vs. state deviation)
-    rho = 1
+# Environment variables that set the thread count of the common BLAS libraries
+BLAS_THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
 
-    # Loop through all initial states
-    for initial_idx in range(n_states):
-        initial_state = normalize_state(states_x0[:, initial_idx])
-        
-        # Loop through all target states
-        for target_idx in range(n_states):
-            target_state = normalize_state(states_xf[:, target_idx])
-
-            control_task = {
-                "x0": initial_state,
-                "xf": target_state,
-                "B": control_set,
-                "S": trajectory_constraints,
-                "rho": rho
-            }
-            control_tasks.append(control_task)        
-            
-    return control_tasks   
-
-def get_control_energy(subject_id, condition_type, threshold, root_dir, output_root, states_root, n_roi=210):
+def get_control_energy(subject_id, condition_type, threshold, root_dir, output_root, states_root, n_roi=210,
+                       states_matrix=None, dtype=np.float64, adjacency=None):
     """
     Calculate optimal control energy for a single subject across all state transitions.
     
@@ -66,6 +34,13 @@ def get_control_energy(subject_id, condition_type, threshold, root_dir, output_r
         output_root (str): Path to save energy results.
         states_root (str): Path to extracted brain states.
         n_roi (int): Number of ROIs to include (default 210 for BNA subcortical cut).
+        states_matrix (np.ndarray): States matrix (Nodes x States) of the subject, if already built
+            (optional; otherwise loaded from states_root).
+        dtype (type): Precision of the solver (np.float64 by default; np.float32 roughly halves
+            the solve time for exploratory runs, at a relative error of the energies around 1e-4).
+        adjacency (np.ndarray): Template SC matrix shared by all subjects (Nodes x Nodes), used
+            instead of the subject's own SC (optional; results are then saved as
+            {subject_id}_OCE_templateSC_T1_{threshold}.csv, next to the individual-SC results).
     """
     
     # 1. Setup Output Directory
@@ -74,105 +49,194 @@ def get_control_energy(subject_id, condition_type, threshold, root_dir, output_r
         os.makedirs(results_dir, exist_ok=True)
     
     # 2. Load Brain States
-    # State file path logic matches the output from Brain_State_Analysis
-    states_file = os.path.join(states_root, condition_type, threshold, 'state-maps_subject-level.csv')
-    
-    if not os.path.exists(states_file):
-        print(f"Error: State file not found at {states_file}")
-        return
-
-    states_all_df = pd.read_csv(states_file) 
-    
-    # Filter for current subject
-    # Check if 'subject' column exists, handle potential type mismatch (int vs str)
-    states_all_df['subject'] = states_all_df['subject'].astype(str)
-    subj_states_df = states_all_df[states_all_df['subject'] == str(subject_id)]
-    
-    if subj_states_df.empty:
-        print(f"Warning: No states found for subject {subject_id}")
-        return
-
-    # Define Labels (Order matters!)
-    # Note: If running NoLIM analysis, ensure the input states CSV does not contain Limbic, 
-    # or handle the label list dynamically. Here we assume standard 7 networks for simplicity.
-    labels = ['Vis', 'SomMot', 'DorsAttn', 'VentAttn', 'Limbic', 'Frontoparietal', 'Default']
-    # Filter out labels not present in the dataframe (handles NoLIM case implicitly if label is missing)
-    present_labels = [l for l in labels if l in subj_states_df['state'].unique()]
-    
-    n_states = len(present_labels)
-    states_matrix = np.zeros((n_roi, n_states))
-
-    for idx, label in enumerate(present_labels):
-        temp_state = subj_states_df[subj_states_df['state'] == label]['value'].values
-        # Ensure dimensionality matches
-        if len(temp_state) == n_roi:
-            states_matrix[:, idx] = temp_state
-        else:
-             print(f"Error: Dimension mismatch for subject {subject_id}, state {label}. Expected {n_roi}, got {len(temp_state)}")
-             return
+    # Per-subject states matrix (Nodes x States) saved by the extract scripts if available,
+    # otherwise the subject is selected from the group state maps table
+    if states_matrix is None:
+        states_matrix = load_states_matrix(os.path.join(states_root, condition_type, threshold), subject_id, n_roi)
+        if states_matrix is None:
+            return
+    n_states = states_matrix.shape[1]
 
     # 3. Load Structural Connectivity (A Matrix)
     # Assumes file naming: {subject_id}_FA_sc.csv
-    adjacency_path = os.path.join(root_dir, f'sc_{condition_type}', f'{subject_id}_FA_sc.csv')
-    
-    if not os.path.exists(adjacency_path):
-        print(f"Error: SC file not found at {adjacency_path}")
-        return
+    if adjacency is not None:
+        adjacency_temp = adjacency
+    else:
+        adjacency_path = os.path.join(root_dir, f'sc_{condition_type}', f'{subject_id}_FA_sc.csv')
+        adjacency_temp = load_sc(adjacency_path)
+        
+        if adjacency_temp is None:
+            print(f"Error: SC file not found at {adjacency_path}")
+            return
         
-    adjacency_temp = pd.read_csv(adjacency_path, header=None).values
-    # Slice to ROI count (e.g., 210)
-    adjacency_temp = adjacency_temp[:n_roi, :n_roi]   
+    # Slice to ROI count (e.g., 210), as a writable copy
+    adjacency_temp = np.array(adjacency_temp[:n_roi, :n_roi])
     np.fill_diagonal(adjacency_temp, 0) # Remove self-connections
             
-    # 4. Prepare Control Tasks
-    control_set = np.eye(n_roi) # Full control (B = Identity)
-    control_tasks = assemble_control_tasks(states_matrix, states_matrix, control_set, n_roi)
+    # 4. Prepare the System and States
+    # Every state (normalized to unit norm) is both an initial and a target state.
+    # A is normalized once for a continuous system (c=1), as in nctpy's ComputeControlEnergy;
+    # the trajectory constraints are Identity and rho = 1.
+    # Normalization runs in float64; the solver then runs in the requested dtype.
+    control_set = np.eye(n_roi, dtype=dtype) # Full control (B = Identity)
+    states_norm = normalize_states(states_matrix).astype(dtype)
+    A_norm = matrix_normalization(adjacency_temp, system="continuous", c=1).astype(dtype)
 
     print(f'Processing Subject: {subject_id} | Condition: {condition_type} | States: {n_states}', flush=True)
 
     # 5. Compute Control Energy (T=1)
-    # T represents the time horizon for the transition
-    compute_energy_t1 = ComputeControlEnergy(
-        A=adjacency_temp, control_tasks=control_tasks, system="continuous", c=1, T=1
-    )
-    compute_energy_t1.run()        
-    oce_t1 = np.reshape(compute_energy_t1.E, (n_states, n_states))
-    del compute_energy_t1
+    # T represents the time horizon for the transition.
+    # All n_states x n_states transitions come from one solve of the system.
+    oce_t1 = transition_energy_matrix(A_norm, control_set, states_norm, states_norm, T=1)
 
     # 6. Compute Control Energy (T=3) - Optional based on your research need
-    # compute_energy_t3 = ComputeControlEnergy(
-    #     A=adjacency_temp, control_tasks=control_tasks, system="continuous", c=1, T=3
-    # )
-    # compute_energy_t3.run()        
-    # oce_t3 = np.reshape(compute_energy_t3.E, (n_states, n_states))
-    # del compute_energy_t3
+    # oce_t3 = transition_energy_matrix(A_norm, control_set, states_norm, states_norm, T=3)
                 
     # 7. Save Results
     print(f'Saving results for {subject_id}...')
     
-    df_t1 = pd.DataFrame(oce_t1)
-    df_t1.to_csv(os.path.join(results_dir, f'{subject_id}_OCE_T1_{threshold}.csv'), header=False, index=False)
+    # 17 significant digits: values read back are exactly the computed energies.
+    # Written to a temporary file and renamed, so a rewrite replaces the file and changes the
+    # directory's mtime, which organize_energy_results.py uses to detect new results.
+    sc_tag = '_templateSC' if adjacency is not None else ''
+    oce_path = os.path.join(results_dir, f'{subject_id}_OCE{sc_tag}_T1_{threshold}.csv')
+    tmp_path = f'{oce_path}.{os.getpid()}.tmp'
+    np.savetxt(tmp_path, oce_t1, delimiter=',', fmt='%.17g')
+    os.replace(tmp_path, oce_path)
     
-    # df_t3 = pd.DataFrame(oce_t3)
-    # df_t3.to_csv(os.path.join(results_dir, f'{subject_id}_OCE_T3_{threshold}.csv'), header=False, index=False)
+    # np.savetxt(os.path.join(results_dir, f'{subject_id}_OCE{sc_tag}_T3_{threshold}.csv'), oce_t3, delimiter=',', fmt='%.17g')
+
+def get_control_energy_batch(subject_ids, condition_type, threshold, root_dir, output_root, states_root, n_roi=210,
+                             n_workers=None, dtype=np.float64, template_sc=None):
+    """
+    Calculate optimal control energy for several subjects in one run.
+    
+    Subjects are independent and are processed in parallel worker processes (n_workers,
+    default: the number of CPUs available to this process, at most one per subject). Each
+    worker's BLAS is limited to an equal share of those CPUs, so the workers' multithreaded
+    matrix exponentials do not oversubscribe the cores; a BLAS thread count already set in
+    the environment is left as it is. A single subject, or n_workers=1, runs in this process
+    with the full BLAS thread pool. The group state maps table (needed only for subjects without
+    a saved states matrix) is read once, here, and each worker receives only the states
+    matrix of its subject. Each subject keeps its own n_roi-node system: stacking subjects
+    into one block-diagonal system would make every matrix exponential cubic in the total
+    number of nodes.
+    
+    With a template SC, every subject has the same system (A, B = Identity, S, rho, T):
+    nct_solver keeps the last system it built, so each worker computes its matrix
+    exponentials once and only propagates the states of the following subjects.
+    
+    Args:
+        subject_ids (list): Subject Identifiers.
+        condition_type, threshold, root_dir, output_root, states_root, n_roi, dtype: As in get_control_energy.
+        n_workers (int): Number of worker processes.
+        template_sc (str): Path of a template SC matrix (CSV, or its .npy cache) used for all
+            subjects instead of their own SC (optional).
+    """
+    adjacency = None
+    if template_sc is not None:
+        adjacency = load_sc(template_sc)
+        if adjacency is None:
+            print(f"Error: Template SC file not found at {template_sc}")
+            return
+        adjacency = np.array(adjacency)
+    
+    states_dir = os.path.join(states_root, condition_type, threshold)
+    states_table = None
+    tasks = [] # (subject_id, states_matrix or None)
+    
+    # Subjects with a saved states matrix load it in their worker;
+    # the others are read from the table in one pass
+    missing_npy = [subject_id for subject_id in subject_ids
+                   if not os.path.exists(states_npy_path(states_dir, subject_id))]
+    missing_npy_set = set(missing_npy)
+    
+    for subject_id in subject_ids:
+        if subject_id not in missing_npy_set:
+            tasks.append((subject_id, None))
+            continue
+        
+        if states_table is None:
+            states_table = load_states_table(states_dir, missing_npy)
+            if states_table is None:
+                return
+        states_matrix = states_matrix_from_table(states_table, subject_id, n_roi)
+        if states_matrix is not None:
+            tasks.append((subject_id, states_matrix))
+    
+    if not tasks:
+        return
+    
+    worker = partial(_get_control_energy_task, condition_type=condition_type, threshold=threshold,
+                     root_dir=root_dir, output_root=output_root, states_root=states_root, n_roi=n_roi,
+                     dtype=dtype, adjacency=adjacency)
+    n_cpus = _available_cpus()
+    n_workers = min(n_workers or n_cpus, len(tasks))
+    if n_workers == 1:
+        for subject_id, states_matrix in tasks:
+            worker(subject_id, states_matrix)
+        return
+    
+    # BLAS reads its thread count when it is loaded, i.e. when a worker imports numpy, so the
+    # limit is set in the environment inherited by freshly spawned (not forked) workers
+    with _blas_threads_env(max(1, n_cpus // n_workers)), \
+            ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        list(executor.map(worker, *zip(*tasks)))
+
+def _available_cpus():
+    """Number of CPUs this process may run on (e.g. its SLURM allocation), not of the machine."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+@contextmanager
+def _blas_threads_env(n_threads):
+    """
+    Set the BLAS thread count variables of os.environ to n_threads, removing them again on exit.
+
+    If the user has set any of them (e.g. OMP_NUM_THREADS=1 in a job script), the environment
+    is left unchanged: setting the others could raise the thread count of a library that
+    would otherwise follow the user's setting.
+    """
+    if any(name in os.environ for name in BLAS_THREAD_VARS):
+        yield
+        return
+    os.environ.update(dict.fromkeys(BLAS_THREAD_VARS, str(n_threads)))
+    try:
+        yield
+    finally:
+        for name in BLAS_THREAD_VARS:
+            os.environ.pop(name, None)
+
+def _get_control_energy_task(subject_id, states_matrix, **kwargs):
+    """Worker entry point of get_control_energy_batch (positional arguments for executor.map)."""
+    get_control_energy(subject_id, states_matrix=states_matrix, **kwargs)
 
 if __name__ == "__main__":
     # Argument Parser for CLI usage (e.g., for cluster jobs)
-    parser = argparse.ArgumentParser(description="Calculate Control Energy for a single subject.")
-    parser.add_argument("--sub_id", required=True, help="Subject ID")
+    parser = argparse.ArgumentParser(description="Calculate Control Energy for one or more subjects.")
+    parser.add_argument("--sub_id", required=True, nargs='+', help="Subject ID(s)")
     parser.add_argument("--condition", required=True, choices=['HC', 'MDD'], help="Group Condition")
     parser.add_argument("--threshold", default='nonthr', help="State extraction threshold type")
     parser.add_argument("--root_dir", default='../../ukb_raw_data/', help="Path to raw data")
     parser.add_argument("--output_dir", default='../results/TCE/', help="Path to save results")
     parser.add_argument("--states_dir", default='../results/state_maps_results/', help="Path to extracted states")
+    parser.add_argument("--n_workers", type=int, default=None, help="Number of parallel worker processes (default: all CPUs)")
+    parser.add_argument("--dtype", default='float64', choices=['float64', 'float32'],
+                        help="Solver precision (float32 for faster exploratory runs)")
+    parser.add_argument("--template_sc", default=None,
+                        help="Template SC matrix (CSV) used for all subjects instead of their own SC")
     
     args = parser.parse_args()
     
-    get_control_energy(
-        subject_id=args.sub_id,
+    get_control_energy_batch(
+        subject_ids=args.sub_id,
         condition_type=args.condition,
         threshold=args.threshold,
         root_dir=args.root_dir,
         output_root=args.output_dir,
-        states_root=args.states_dir
+        states_root=args.states_dir,
+        n_workers=args.n_workers,
+        dtype=np.dtype(args.dtype).type,
+        template_sc=args.template_sc
     )
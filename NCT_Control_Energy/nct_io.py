@@ -0,0 +1,171 @@
+"""
+Input loading shared by the subject-level control energy scripts: brain states (per-subject
+states matrices or the group state maps table written by Brain_State_Analysis) and structural
+connectivity matrices.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow.dataset as ds
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+# Brain state labels (Order matters!). States missing from a subject's table are skipped,
+# which handles the NoLIM analysis (no Limbic state).
+STATE_LABELS = ['Vis', 'SomMot', 'DorsAttn', 'VentAttn', 'Limbic', 'Frontoparietal', 'Default']
+
+def load_states_table(states_dir, subject_ids=None):
+    """
+    Load the group state maps table (long format, one row per subject, state and ROI).
+
+    The table is read from state-maps_subject-level.parquet when it exists and is not older than
+    the CSV, else from the CSV. With pyarrow, a CSV table without an up-to-date Parquet copy is
+    converted to Parquet next to it (skipped if the directory is read-only), and only the rows
+    of subject_ids are read: the subject filter is applied while scanning the Parquet file.
+
+    Args:
+        states_dir (str): Directory of the state maps table.
+        subject_ids (list): Subjects to load (optional; default: all subjects).
+
+    Returns:
+        pd.DataFrame: State maps with subject IDs as str, or None if the table is missing.
+    """
+    # State file path logic matches the output from Brain_State_Analysis
+    states_file = os.path.join(states_dir, 'state-maps_subject-level.csv')
+    states_parquet = os.path.splitext(states_file)[0] + '.parquet'
+    # A Parquet table older than the CSV is stale (e.g. states re-extracted without pyarrow)
+    use_parquet = os.path.exists(states_parquet) and not (
+        os.path.exists(states_file) and os.path.getmtime(states_file) > os.path.getmtime(states_parquet))
+
+    if HAS_PYARROW and not use_parquet and os.path.exists(states_file):
+        # Conversion to Parquet; the temporary file is per process, as several jobs may convert at once
+        tmp_path = f'{states_parquet}.{os.getpid()}.tmp'
+        try:
+            pd.read_csv(states_file).astype({'subject': str}).to_parquet(tmp_path, index=False, compression='zstd')
+            os.replace(tmp_path, states_parquet)
+            use_parquet = True
+        except OSError:
+            # Read-only states directory: read the CSV
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    if use_parquet:
+        if HAS_PYARROW:
+            subject_filter = None if subject_ids is None else ds.field('subject').isin([str(s) for s in subject_ids])
+            states_all_df = ds.dataset(states_parquet).to_table(filter=subject_filter).to_pandas()
+        else:
+            states_all_df = pd.read_parquet(states_parquet)
+    elif os.path.exists(states_file):
+        states_all_df = pd.read_csv(states_file)
+    else:
+        print(f"Error: State file not found at {states_file}")
+        return None
+
+    # Handle potential type mismatch of subject IDs (int vs str)
+    states_all_df['subject'] = states_all_df['subject'].astype(str)
+    return states_all_df
+
+def states_matrix_from_table(states_all_df, subject_id, n_roi):
+    """
+    Build the states matrix (Nodes x States) of one subject from the group state maps table.
+
+    Args:
+        states_all_df (pd.DataFrame): State maps table from load_states_table.
+        subject_id (int/str): Subject Identifier.
+        n_roi (int): Expected number of ROIs per state.
+
+    Returns:
+        np.ndarray: States matrix, or None if the subject's states are missing.
+    """
+    # Filter for current subject
+    subj_states_df = states_all_df[states_all_df['subject'] == str(subject_id)]
+
+    if subj_states_df.empty:
+        print(f"Warning: No states found for subject {subject_id}")
+        return None
+
+    # Filter out labels not present in the dataframe (handles NoLIM case implicitly if label is missing)
+    state_counts = subj_states_df['state'].value_counts()
+    present_labels = [l for l in STATE_LABELS if state_counts.get(l, 0) > 0]
+
+    # Ensure dimensionality matches
+    for label in present_labels:
+        if state_counts[label] != n_roi:
+            print(f"Error: Dimension mismatch for subject {subject_id}, state {label}. Expected {n_roi}, got {state_counts[label]}")
+            return None
+
+    # One pivot instead of one scan per state: rows are the ROIs in file order within each state
+    subj_states_df = subj_states_df[subj_states_df['state'].isin(present_labels)]
+    states_pivot = subj_states_df.assign(roi_idx=subj_states_df.groupby('state').cumcount()) \
+        .pivot(index='roi_idx', columns='state', values='value')
+
+    return states_pivot[present_labels].to_numpy(dtype=np.float64)
+
+def states_npy_path(states_dir, subject_id):
+    """Path of the per-subject states matrix saved by the extract scripts."""
+    return os.path.join(states_dir, f'{subject_id}_states_matrix.npy')
+
+def load_states_matrix(states_dir, subject_id, n_roi, states_table=None):
+    """
+    Load the states matrix (Nodes x States) of one subject.
+
+    The per-subject states matrix saved by the extract scripts is used if available,
+    otherwise the subject is selected from the group state maps table.
+
+    Args:
+        states_dir (str): Directory of the extracted states.
+        subject_id (int/str): Subject Identifier.
+        n_roi (int): Expected number of ROIs.
+        states_table (pd.DataFrame): Group state maps table already loaded with load_states_table
+            (optional; only the subject's rows are read if needed and not given).
+
+    Returns:
+        np.ndarray: States matrix, or None if the subject's states are missing.
+    """
+    states_npy = states_npy_path(states_dir, subject_id)
+    if os.path.exists(states_npy):
+        states_matrix = np.load(states_npy).astype(np.float64)
+        if states_matrix.shape[0] != n_roi:
+            print(f"Error: Dimension mismatch for subject {subject_id}. Expected {n_roi}, got {states_matrix.shape[0]}")
+            return None
+        return states_matrix
+
+    if states_table is None:
+        states_table = load_states_table(states_dir, [subject_id])
+        if states_table is None:
+            return None
+    return states_matrix_from_table(states_table, subject_id, n_roi)
+
+def load_sc(csv_path):
+    """
+    Load a structural connectivity matrix, caching it as .npy next to the CSV.
+
+    The .npy file (also written by Data_Preprocessing/convert_csv_to_npy.py) is memory-mapped
+    when it exists and is not older than the CSV; otherwise the CSV is parsed with np.loadtxt
+    and the cache is (re)written.
+
+    Returns:
+        np.ndarray: SC matrix (read-only if memory-mapped), or None if the CSV is missing.
+    """
+    npy_path = os.path.splitext(csv_path)[0] + '.npy'
+    csv_exists = os.path.exists(csv_path)
+    if os.path.exists(npy_path) and not (csv_exists and os.path.getmtime(csv_path) > os.path.getmtime(npy_path)):
+        return np.load(npy_path, mmap_mode='r')
+    if not csv_exists:
+        return None
+
+    sc = np.loadtxt(csv_path, delimiter=',', dtype=np.float64)
+    # Write to a per-process temporary file first, so neither a concurrent reader nor another
+    # job caching the same subject (baseline and regional scripts) sees a partial cache
+    tmp_path = f'{npy_path}.{os.getpid()}.tmp.npy'
+    try:
+        np.save(tmp_path, sc)
+        os.replace(tmp_path, npy_path)
+    except OSError:
+        # Read-only data directory: keep parsing the CSV
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return sc
@@ -0,0 +1,129 @@
+"""
+Batched optimal control energy for continuous-time systems.
+
+Re-implements the continuous-time solver of nctpy (nctpy.energies.get_control_inputs with
+xr='zero', energy as in nctpy.pipelines.ComputeControlEnergy) for many transitions that share
+one system (A_norm, B, S, rho, T). The matrix exponentials and the costate solve depend only on
+the system, so they are computed once and every transition is a column of the same matrix products.
+
+The control input is linear in (x0, xf), so the energy is a quadratic form in them: the energies of
+all pairs of initial and target states follow from the responses to each state on its own.
+"""
+from functools import lru_cache
+import numpy as np
+import scipy.integrate
+import scipy.linalg
+
+DT = 0.001 # Integration step of nctpy's continuous-time solver
+
+_last_system = None # (key, system) of the most recent continuous_system call
+
+def continuous_system(A_norm, B, T=1, rho=1, S=None):
+    """
+    Propagators of the joint state-costate system d/dt [x; p] = M [x; p], with
+    M = [[A_norm, -B B^T / (2 rho)], [-2 S, -A_norm^T]].
+
+    The result for the most recent system is kept and returned again while the inputs are
+    identical (compared byte for byte), so repeated solves of one system skip both matrix
+    exponentials and the LU factorization. The propagators have the dtype of A_norm
+    (float32 or float64).
+
+    Args:
+        A_norm (np.ndarray): Normalized structural connectivity matrix (Nodes x Nodes).
+        B (np.ndarray): Control input matrix (Nodes x Nodes).
+        T (float): Time horizon.
+        rho (float): Mixing parameter (energy cost vs. state deviation).
+        S (np.ndarray): State trajectory constraints (default: Identity).
+
+    Returns:
+        tuple: (E11, E12_lu, E_dt): the top-left block of e^{MT}, the LU factorization
+               (scipy.linalg.lu_factor) of its top-right block, and e^{M DT}.
+    """
+    global _last_system
+    n_nodes = A_norm.shape[0]
+    if S is None:
+        S = np.eye(n_nodes, dtype=A_norm.dtype)
+
+    key = (A_norm.tobytes(), B.tobytes(), S.tobytes(), A_norm.shape, A_norm.dtype, T, rho)
+    if _last_system is not None and _last_system[0] == key:
+        return _last_system[1]
+
+    M = np.block([[A_norm, -np.dot(B, B.T) / (2 * rho)],
+                  [-2 * S, -A_norm.T]]).astype(A_norm.dtype, copy=False)
+    E = scipy.linalg.expm(M * T)
+    system = (E[:n_nodes, :n_nodes], scipy.linalg.lu_factor(E[:n_nodes, n_nodes:], check_finite=False), scipy.linalg.expm(M * DT))
+    _last_system = (key, system)
+    return system
+
+def normalize_states(states):
+    """
+    Scale every state (column) to unit Euclidean norm, as nctpy.utils.normalize_state does for one state.
+
+    Args:
+        states (np.ndarray): States (Nodes x States).
+
+    Returns:
+        np.ndarray: Normalized states, same shape.
+    """
+    return states / np.linalg.norm(states, axis=0, keepdims=True)
+
+@lru_cache(maxsize=None)
+def simpson_weights(n_samples):
+    """
+    Weights w such that w @ y equals scipy.integrate.simpson(y) for n_samples unit-spaced samples.
+
+    Computed once per n_samples; the returned array is shared and read-only.
+    """
+    weights = scipy.integrate.simpson(np.eye(n_samples), axis=0)
+    weights.setflags(write=False)
+    return weights
+
+def transition_energy_matrix(A_norm, B, x0, xf, T=1, rho=1, S=None):
+    """
+    Optimal control energy of every pair of initial and target states of one continuous-time system.
+
+    Each state is propagated once: the initial states with p0 = -E12^-1 E11 x0 and the targets
+    with x0 = 0, p0 = E12^-1 xf. The input of a transition is the sum of the two responses, so its
+    energy is a_i + b_j + 2 c_ij with (a, b, c) read from one Simpson-weighted Gram matrix of the
+    responses, instead of propagating all n_x0 * n_xf transitions.
+
+    Args:
+        A_norm (np.ndarray): Normalized structural connectivity matrix (Nodes x Nodes).
+        B (np.ndarray): Control input matrix (Nodes x Nodes).
+        x0 (np.ndarray): Initial states (Nodes x n_x0).
+        xf (np.ndarray): Target states (Nodes x n_xf).
+        T (float): Time horizon.
+        rho (float): Mixing parameter (energy cost vs. state deviation).
+        S (np.ndarray): State trajectory constraints (default: Identity).
+
+    Returns:
+        np.ndarray: Energy matrix of shape (n_x0, n_xf), in the dtype of A_norm; entry (i, j) is the
+                    energy of x0[:, i] -> xf[:, j]. A state containing NaN (e.g. a normalized zero
+                    map) gives NaN for its own row or column only, as in nctpy.
+    """
+    n_nodes = A_norm.shape[0]
+    n_x0 = x0.shape[1]
+    E11, E12_lu, E_dt = continuous_system(A_norm, B, T=T, rho=rho, S=S)
+
+    # Initial [x; p] of the responses to each initial state and to each target state. The columns
+    # are solved independently: a NaN state (a zero map normalized by normalize_states) only gives
+    # NaN energies for its own row and column, as in nctpy, so the finiteness check is skipped.
+    p0 = scipy.linalg.lu_solve(E12_lu, np.concatenate((-np.dot(E11, x0), xf), axis=1), check_finite=False)
+    z = np.concatenate((np.concatenate((x0, np.zeros_like(xf)), axis=1), p0), axis=0)
+
+    # Control input u(t) = -B^T p(t) / (2 rho) of every response over steps of DT
+    costate_to_input = -B.T / (2 * rho)
+    n_steps = int(np.round(T / DT))
+    u = np.empty((n_steps + 1, n_nodes, z.shape[1]), dtype=E_dt.dtype)
+    u[0] = np.dot(costate_to_input, z[n_nodes:])
+    for i in range(1, n_steps + 1):
+        z = np.dot(E_dt, z)
+        u[i] = np.dot(costate_to_input, z[n_nodes:])
+
+    # Simpson-weighted inner products of all responses, summed over time and nodes
+    weighted = u * simpson_weights(n_steps + 1).astype(u.dtype)[:, None, None]
+    gram = np.dot(weighted.reshape(-1, z.shape[1]).T, u.reshape(-1, z.shape[1]))
+    energy_x0 = np.diag(gram)[:n_x0]
+    energy_xf = np.diag(gram)[n_x0:]
+
+    return energy_x0[:, None] + energy_xf[None, :] + 2 * gram[:n_x0, n_x0:]
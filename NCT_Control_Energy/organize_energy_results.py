@@ -1,9 +1,18 @@
 import argparse
 import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import numpy as np
 import pandas as pd
 import scipy.io as sio
 
+try:
+    import pyarrow # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
 def load_subject_data(root_dir, condition, threshold, sub_id, T_value):
     """
     Load energy matrix for a single subject from CSV or MAT.
@@ -14,116 +23,226 @@ def load_subject_data(root_dir, condition, threshold, sub_id, T_value):
     file_name = f'{sub_id}_OCE_T{T_value}_{threshold}.csv'
     file_path = os.path.join(root_dir, 'energy', condition, threshold, file_name)
     
-    if os.path.exists(file_path):
-        # Read CSV (no header)
-        return pd.read_csv(file_path, header=None).values
-    else:
+    try:
+        # Read CSV (no header); the C parser releases the GIL, so files can be read in threads
+        return pd.read_csv(file_path, header=None, dtype=np.float64, engine='c').values
+    except FileNotFoundError:
         print(f"Warning: File not found {file_path}")
         return None
+    except ValueError as e:
+        # Empty or malformed CSV
+        print(f"Warning: Could not read {file_path}: {str(e).strip()}")
+        return None
+
+def common_shape(matrices):
+    """Most frequent shape among the given energy matrices."""
+    return Counter(matrix.shape for matrix in matrices).most_common(1)[0][0]
+
+def load_group_data(root_dir, condition, threshold, sub_list, T_value, n_workers):
+    """
+    Load the energy matrices of a group, in sub_list order (None for missing subjects).
+    
+    The CSVs of the subjects in sub_list are packed into one .npz file (subject IDs and
+    stacked matrices), stored next to the group directory together with the mtime and size
+    of each packed CSV, taken from one directory listing. Later runs take a subject's matrix
+    from the pack as long as its CSV has the same mtime and size, and parse only the CSVs
+    that are new or were rewritten. CSVs that cannot be parsed, or whose matrix does not have
+    the group's common shape, are skipped with a warning. In a read-only results directory
+    the pack is not written.
+    """
+    data_dir = os.path.join(root_dir, 'energy', condition, threshold)
+    suffix = f'_OCE_T{T_value}_{threshold}.csv'
+    pack_path = os.path.join(root_dir, 'energy', condition, f'OCE_T{T_value}_{threshold}_packed.npz')
+    
+    # (mtime, size) of the CSV of every listed subject present in the directory
+    wanted = {f'{sub_id}{suffix}' for sub_id in sub_list}
+    csv_stats = {}
+    if os.path.isdir(data_dir):
+        for entry in os.scandir(data_dir):
+            if entry.name in wanted:
+                st = entry.stat()
+                csv_stats[entry.name[:-len(suffix)]] = (st.st_mtime_ns, st.st_size)
+    
+    # Packed matrices whose CSV is unchanged
+    pack_record = {}
+    matrices = {}
+    if os.path.exists(pack_path):
+        with np.load(pack_path) as pack:
+            if 'subject_stats' in pack.files:
+                pack_record = dict(zip(pack['subject_ids'].tolist(), map(tuple, pack['subject_stats'].tolist())))
+                matrices = {sub_id: matrix for sub_id, matrix in zip(pack_record, pack['oce'])
+                            if csv_stats.get(sub_id) == pack_record[sub_id]}
+    
+    # Parse the new and rewritten CSVs, in threads
+    to_read = [sub_id for sub_id in csv_stats if sub_id not in matrices]
+    if to_read:
+        loader = partial(load_subject_data, root_dir, condition, threshold, T_value=T_value)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            matrices.update((sub_id, matrix) for sub_id, matrix in zip(to_read, executor.map(loader, to_read))
+                            if matrix is not None)
+    
+    if matrices:
+        shape = common_shape(matrices.values())
+        for sub_id in [sub_id for sub_id, matrix in matrices.items() if matrix.shape != shape]:
+            print(f"Warning: Skipping {os.path.join(data_dir, f'{sub_id}{suffix}')}: "
+                  f"shape {matrices[sub_id].shape}, expected {shape}")
+            del matrices[sub_id]
+    
+    new_record = {sub_id: csv_stats[sub_id] for sub_id in sorted(matrices)}
+    if matrices and new_record != pack_record:
+        # Write to a per-process temporary file first so a concurrent reader never sees a partial pack
+        tmp_path = f'{pack_path[:-len(".npz")]}.{os.getpid()}.tmp.npz'
+        try:
+            np.savez(tmp_path, subject_ids=np.array(list(new_record)),
+                     oce=np.stack([matrices[sub_id] for sub_id in new_record]),
+                     subject_stats=np.array(list(new_record.values()), dtype=np.int64))
+            os.replace(tmp_path, pack_path)
+        except OSError:
+            # Read-only results directory: keep parsing the CSVs
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    for sub_id in sub_list:
+        if str(sub_id) not in csv_stats:
+            print(f"Warning: File not found {os.path.join(data_dir, f'{sub_id}{suffix}')}")
+    return [matrices.get(str(sub_id)) for sub_id in sub_list]
 
-def organize_energy_metrics(root_dir, output_dir, mdd_list, hc_list, threshold, T_value):
+def organize_energy_metrics(root_dir, output_dir, mdd_list, hc_list, threshold, T_value, n_workers=None, legacy=False):
     """
     Aggregates energy matrices and computes summary metrics (TE, PE, Stability).
+    
+    Each group is loaded with load_group_data; when its subject files have to be parsed,
+    they are read in a thread pool of n_workers threads (default: min(32, 4 * os.cpu_count())),
+    since loading is I/O-bound.
+    
+    All metrics are saved in one long-format Parquet table (subject_id, condition, metric, value),
+    df_energy_metrics_T{T}_{threshold}.parquet. The former per-metric CSVs (df_oce, df_aveTE,
+    df_avePE, df_global_stability) are written as well if legacy is set or pyarrow is missing.
     """
+    n_workers = n_workers or min(32, 4 * os.cpu_count())
     print(f"\nProcessing: Threshold={threshold}, T={T_value}")
     
-    # Initialize lists to store row data
-    data_all_te = [] # For 7x7 flat (49 rows per sub)
-    data_ave_te = [] # For average TE (1 row per sub)
-    data_ave_pe = [] # For average PE (1 row per sub)
-    data_stability = [] # For global stability (1 row per sub)
-    
-    # Process both groups
+    # Load every available matrix first; the metrics are then computed for all subjects at once
     groups = [('MDD', mdd_list), ('HC', hc_list)]
+    loaded_groups = []
     
     for condition, sub_list in groups:
         print(f"  Loading {condition} group ({len(sub_list)} subjects)...")
-        
-        for sub_id in sub_list:
-            matrix = load_subject_data(root_dir, condition, threshold, sub_id, T_value)
-            
-            if matrix is None:
-                continue
-                
-            n_states = matrix.shape[0]
-            n_transitions = n_states * n_states
-            
-            # --- 1. Flattened TE (All 7x7 pairs) ---
-            # Flatten column-wise (Fortran order) to match MATLAB behavior if needed, 
-            # or row-wise (C order). Let's use Row-major (C) for standard Python/Pandas logic.
-            # If you specifically need column-major (F), change to 'F'.
-            flat_matrix = matrix.flatten(order='C') 
-            
-            for k in range(n_transitions):
-                data_all_te.append({
-                    'subject_id': sub_id,
-                    'condition': condition,
-                    'state_k': f'TE_{k+1}', # 1-based index
-                    'TE': flat_matrix[k]
-                })
+        loaded_groups.append(load_group_data(root_dir, condition, threshold, sub_list, T_value, n_workers))
+
+    # The groups must share one shape as well (e.g. a NoLIM group among 7-state results)
+    loaded_matrices = [matrix for loaded in loaded_groups for matrix in loaded if matrix is not None]
+    if loaded_matrices:
+        shape = common_shape(loaded_matrices)
+        for (condition, sub_list), loaded in zip(groups, loaded_groups):
+            for i, matrix in enumerate(loaded):
+                if matrix is not None and matrix.shape != shape:
+                    print(f"    Warning: Skipping {condition} subject {sub_list[i]}: shape {matrix.shape}, expected {shape}")
+                    loaded[i] = None
+
+    available = [np.array([matrix is not None for matrix in loaded], dtype=bool) for loaded in loaded_groups]
+    n_subjects = int(sum(mask.sum() for mask in available))
+    if n_subjects == 0:
+        print("    Warning: No energy matrices found, nothing saved.")
+        return
 
-            # --- 2. Average Transition Energy (Ave TE) ---
-            # Off-diagonal elements
-            mask_off_diag = ~np.eye(n_states, dtype=bool)
-            ave_te = np.mean(matrix[mask_off_diag])
-            
-            data_ave_te.append({
-                'subject_id': sub_id,
-                'condition': condition,
-                'state_k': 'ave_TE',
-                'ave_TE': ave_te
-            })
-            
-            # --- 3. Average Persistence Energy (Ave PE) ---
-            # Diagonal elements
-            diag_elements = np.diag(matrix)
-            ave_pe = np.mean(diag_elements)
-            
-            data_ave_pe.append({
-                'subject_id': sub_id,
-                'condition': condition,
-                'state_k': 'ave_PE',
-                'ave_PE': ave_pe
-            })
-            
-            # --- 4. Global Stability ---
-            # Defined as 1 / log10(Ave_PE)
-            # Handle potential log(0) or very small numbers
-            if ave_pe > 0:
-                stability = 1 / np.log10(ave_pe)
-            else:
-                stability = np.nan
-                
-            data_stability.append({
-                'subject_id': sub_id,
-                'condition': condition,
-                'state_k': 'global_stability',
-                'stability': stability
-            })
+    # Subject IDs and condition codes (index into groups) of the available subjects, in group order
+    subjects = np.concatenate([np.asarray(sub_list)[mask] for (_, sub_list), mask in zip(groups, available)])
+    condition_codes = np.repeat(np.arange(len(groups), dtype=np.int8), [mask.sum() for mask in available])
+    condition_names = [condition for condition, _ in groups]
+
+    # Copy every matrix once into a preallocated (Subjects, States, States) buffer
+    n_states = next(matrix for loaded in loaded_groups for matrix in loaded if matrix is not None).shape[0]
+    energy = np.empty((n_subjects, n_states, n_states))
+    i = 0
+    for loaded in loaded_groups:
+        for matrix in loaded:
+            if matrix is not None:
+                energy[i] = matrix
+                i += 1
+    n_transitions = n_states * n_states
+    
+    # --- 1. Flattened TE (All 7x7 pairs) ---
+    # Flatten column-wise (Fortran order) to match MATLAB behavior if needed, 
+    # or row-wise (C order). Let's use Row-major (C) for standard Python/Pandas logic.
+    # If you specifically need column-major (F), change the reshape to transpose each matrix first.
+    te_values = energy.reshape(n_subjects, n_transitions)
+
+    # --- 2. Average Transition Energy (Ave TE) ---
+    # Off-diagonal elements: (sum of all elements - trace) / number of off-diagonal elements
+    trace = np.trace(energy, axis1=1, axis2=2)
+    ave_te = (te_values.sum(axis=1) - trace) / (n_states * (n_states - 1))
+    
+    # --- 3. Average Persistence Energy (Ave PE) ---
+    # Diagonal elements
+    ave_pe = trace / n_states
+    
+    # --- 4. Global Stability ---
+    # Defined as 1 / log10(Ave_PE)
+    # Handle potential log(0) or very small numbers
+    stability = np.full(n_subjects, np.nan)
+    positive = ave_pe > 0
+    stability[positive] = 1 / np.log10(ave_pe[positive])
 
-    # --- Save DataFrames ---
     os.makedirs(output_dir, exist_ok=True)
     
+    # --- Save one long-format table of all metrics ---
+    # One row per transition (metric 'TE_k', 1-based index), then one row per subject for each
+    # summary metric ('ave_TE', 'ave_PE', 'global_stability'). Conditions and metric names are
+    # stored as categoricals. Values stay float64: rERC is a small relative difference of ave_TE.
+    metric_names = [f'TE_{k+1}' for k in range(n_transitions)] + ['ave_TE', 'ave_PE', 'global_stability']
+    summary_codes = np.repeat(np.arange(n_transitions, n_transitions + 3), n_subjects)
+    df_metrics = pd.DataFrame({
+        'subject_id': np.concatenate((np.repeat(subjects, n_transitions), np.tile(subjects, 3))),
+        'condition': pd.Categorical.from_codes(
+            np.concatenate((np.repeat(condition_codes, n_transitions), np.tile(condition_codes, 3))),
+            categories=condition_names),
+        'metric': pd.Categorical.from_codes(
+            np.concatenate((np.tile(np.arange(n_transitions), n_subjects), summary_codes)),
+            categories=metric_names),
+        'value': np.concatenate((te_values.ravel(), ave_te, ave_pe, stability))
+    })
+    
+    if HAS_PYARROW:
+        path_metrics = os.path.join(output_dir, f'df_energy_metrics_T{T_value}_{threshold}.parquet')
+        df_metrics.to_parquet(path_metrics, index=False, compression='zstd')
+        print(f"    Saved energy metrics to: {path_metrics}")
+    
+    if HAS_PYARROW and not legacy:
+        return
+    
+    # --- Per-metric CSVs (--legacy, or when pyarrow is not available) ---
+    # (conditions written to CSV as the group names)
+    conditions = pd.Categorical.from_codes(condition_codes, categories=condition_names)
+    df_all_te = pd.DataFrame({
+        'subject_id': np.repeat(subjects, n_transitions),
+        'condition': df_metrics['condition'].values[:n_subjects * n_transitions],
+        'state_k': df_metrics['metric'].values[:n_subjects * n_transitions],
+        'TE': te_values.ravel()
+    })
+    df_ave_te = pd.DataFrame({'subject_id': subjects, 'condition': conditions,
+                              'state_k': 'ave_TE', 'ave_TE': ave_te})
+    df_ave_pe = pd.DataFrame({'subject_id': subjects, 'condition': conditions,
+                              'state_k': 'ave_PE', 'ave_PE': ave_pe})
+    df_stability = pd.DataFrame({'subject_id': subjects, 'condition': conditions,
+                                 'state_k': 'global_stability', 'stability': stability})
+    
     # 1. Full 7x7 TE
-    df_all_te = pd.DataFrame(data_all_te)
     path_all_te = os.path.join(output_dir, f'df_oce_T{T_value}_{threshold}.csv')
     df_all_te.to_csv(path_all_te, index=False)
     print(f"    Saved Full TE to: {path_all_te}")
 
     # 2. Average TE
-    df_ave_te = pd.DataFrame(data_ave_te)
     path_ave_te = os.path.join(output_dir, f'df_aveTE_T{T_value}_{threshold}.csv')
     df_ave_te.to_csv(path_ave_te, index=False)
     print(f"    Saved Ave TE to: {path_ave_te}")
 
     # 3. Average PE
-    df_ave_pe = pd.DataFrame(data_ave_pe)
     path_ave_pe = os.path.join(output_dir, f'df_avePE_T{T_value}_{threshold}.csv')
     df_ave_pe.to_csv(path_ave_pe, index=False)
     print(f"    Saved Ave PE to: {path_ave_pe}")
     
     # 4. Global Stability
-    df_stability = pd.DataFrame(data_stability)
     path_stability = os.path.join(output_dir, f'df_global_stability_T{T_value}_{threshold}.csv')
     df_stability.to_csv(path_stability, index=False)
     print(f"    Saved Stability to: {path_stability}")
@@ -133,7 +252,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Organize and aggregate energy metrics for statistical analysis.")
     parser.add_argument("--root_dir", default='../results/', help="Root directory containing 'energy' folder")
     parser.add_argument("--list_dir", default='../../ukb_raw_data/', help="Directory containing subject list text files")
-    parser.add_argument("--output_dir", default='../results/df_FoDtAr_TP_E/', help="Directory to save aggregated CSVs")
+    parser.add_argument("--output_dir", default='../results/df_FoDtAr_TP_E/', help="Directory to save aggregated metrics")
+    parser.add_argument("--legacy", action='store_true', help="Also write the per-metric CSVs")
     
     args = parser.parse_args()
     
@@ -154,5 +274,6 @@ if __name__ == "__main__":
                 mdd_list, 
                 hc_list, 
                 threshold, 
-                T_val
+                T_val,
+                legacy=args.legacy
             )